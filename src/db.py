@@ -1,5 +1,6 @@
 from sqlmodel import SQLModel, create_engine, text
 from dotenv import load_dotenv
+import math
 import os
 
 load_dotenv(".venv/.env")
@@ -8,7 +9,159 @@ sqlite_url = f"sqlite:///{sqlite_file_name}"
 
 engine = create_engine(sqlite_url, echo=False)
 
-def create_db_and_tables():
+def create_db_and_tables(unique_names: bool = False):
     SQLModel.metadata.create_all(engine)
     with engine.connect() as connection:
         connection.execute(text("PRAGMA foreign_keys=ON"))  # for SQLite only
+    if unique_names:
+        create_unique_name_indexes()
+    create_rollup_triggers()
+
+# the upsert functions need a unique index on name for ON CONFLICT to target
+# this fails with an IntegrityError if a table already has duplicate names
+def create_unique_name_indexes():
+    with engine.begin() as connection:
+        for table in ("hero", "team", "region"):
+            connection.execute(text(f"CREATE UNIQUE INDEX IF NOT EXISTS ux_{table}_name ON {table} (name)"))
+
+def has_unique_name_index(table: str) -> bool:
+    with engine.connect() as connection:
+        statement = text("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = :name")
+        return connection.execute(statement, {"name": f"ux_{table}_name"}).first() is not None
+
+
+# ROLLUPS
+# teamstats and regionstats are kept up to date by triggers so counts don't need
+# to load Team.heroes or Region.heroes. avg_age is stored alongside age_sum and
+# aged_count (heroes with an age) so it can be adjusted one hero at a time
+TEAM_STATS_SELECT = """
+    SELECT team.id, COUNT(hero.id), COALESCE(SUM(hero.age), 0), COUNT(hero.age), AVG(hero.age)
+    FROM team LEFT JOIN hero ON hero.team_id = team.id
+    GROUP BY team.id
+"""
+
+REGION_STATS_SELECT = """
+    SELECT region.id, COUNT(heroregionlink.hero_id), COALESCE(SUM(heroregionlink.is_training), 0)
+    FROM region LEFT JOIN heroregionlink ON heroregionlink.region_id = region.id
+    GROUP BY region.id
+"""
+
+# sign is "+" or "-", row is NEW or OLD
+def _adjust_team_stats(sign: str, row: str) -> str:
+    return f"""
+        UPDATE teamstats SET
+            hero_count = hero_count {sign} 1,
+            age_sum = age_sum {sign} COALESCE({row}.age, 0),
+            aged_count = aged_count {sign} ({row}.age IS NOT NULL)
+        WHERE team_id = {row}.team_id;
+        UPDATE teamstats SET
+            avg_age = CASE WHEN aged_count > 0 THEN CAST(age_sum AS REAL) / aged_count END
+        WHERE team_id = {row}.team_id;
+    """
+
+def _adjust_region_stats(sign: str, row: str) -> str:
+    return f"""
+        UPDATE regionstats SET
+            hero_count = hero_count {sign} 1,
+            training_count = training_count {sign} {row}.is_training
+        WHERE region_id = {row}.region_id;
+    """
+
+ROLLUP_TRIGGERS = {
+    "team_stats_team_insert": """
+        AFTER INSERT ON team BEGIN
+            INSERT INTO teamstats (team_id, hero_count, age_sum, aged_count, avg_age) VALUES (NEW.id, 0, 0, 0, NULL);
+        END
+    """,
+    "team_stats_team_delete": """
+        AFTER DELETE ON team BEGIN
+            DELETE FROM teamstats WHERE team_id = OLD.id;
+        END
+    """,
+    "team_stats_hero_insert": f"""
+        AFTER INSERT ON hero BEGIN
+            {_adjust_team_stats("+", "NEW")}
+        END
+    """,
+    "team_stats_hero_delete": f"""
+        AFTER DELETE ON hero BEGIN
+            {_adjust_team_stats("-", "OLD")}
+        END
+    """,
+    "team_stats_hero_update": f"""
+        AFTER UPDATE OF team_id, age ON hero BEGIN
+            {_adjust_team_stats("-", "OLD")}
+            {_adjust_team_stats("+", "NEW")}
+        END
+    """,
+    "region_stats_region_insert": """
+        AFTER INSERT ON region BEGIN
+            INSERT INTO regionstats (region_id, hero_count, training_count) VALUES (NEW.id, 0, 0);
+        END
+    """,
+    "region_stats_region_delete": """
+        AFTER DELETE ON region BEGIN
+            DELETE FROM regionstats WHERE region_id = OLD.id;
+        END
+    """,
+    "region_stats_link_insert": f"""
+        AFTER INSERT ON heroregionlink BEGIN
+            {_adjust_region_stats("+", "NEW")}
+        END
+    """,
+    "region_stats_link_delete": f"""
+        AFTER DELETE ON heroregionlink BEGIN
+            {_adjust_region_stats("-", "OLD")}
+        END
+    """,
+    "region_stats_link_update": f"""
+        AFTER UPDATE OF region_id, is_training ON heroregionlink BEGIN
+            {_adjust_region_stats("-", "OLD")}
+            {_adjust_region_stats("+", "NEW")}
+        END
+    """,
+}
+
+# a database created before the triggers existed gets rebuilt once
+def create_rollup_triggers():
+    with engine.begin() as connection:
+        existing = set(connection.execute(text("SELECT name FROM sqlite_master WHERE type = 'trigger'")).scalars())
+        for name, body in ROLLUP_TRIGGERS.items():
+            connection.execute(text(f"CREATE TRIGGER IF NOT EXISTS {name} {body}"))
+    if not existing.issuperset(ROLLUP_TRIGGERS):
+        rebuild_rollups()
+
+# recompute every rollup row from hero and heroregionlink
+def rebuild_rollups():
+    with engine.begin() as connection:
+        connection.execute(text("DELETE FROM teamstats"))
+        connection.execute(text(f"INSERT INTO teamstats (team_id, hero_count, age_sum, aged_count, avg_age) {TEAM_STATS_SELECT}"))
+        connection.execute(text("DELETE FROM regionstats"))
+        connection.execute(text(f"INSERT INTO regionstats (region_id, hero_count, training_count) {REGION_STATS_SELECT}"))
+
+# counts must match exactly, avg_age within float tolerance and NULL when no hero has an age
+def _team_stats_match(stored: tuple | None, expected: tuple | None) -> bool:
+    if stored is None or expected is None:
+        return stored == expected
+    if stored[:3] != expected[:3]:
+        return False
+    if stored[3] is None or expected[3] is None:
+        return stored[3] is None and expected[3] is None
+    return math.isclose(stored[3], expected[3])
+
+# returns a description of every rollup row that doesn't match the source tables
+# an empty list means the rollups are consistent
+def check_rollups() -> list[str]:
+    problems = []
+    with engine.connect() as connection:
+        stored = {row[0]: tuple(row[1:]) for row in connection.execute(text("SELECT team_id, hero_count, age_sum, aged_count, avg_age FROM teamstats"))}
+        expected = {row[0]: tuple(row[1:]) for row in connection.execute(text(TEAM_STATS_SELECT))}
+        for team_id in stored.keys() | expected.keys():
+            if not _team_stats_match(stored.get(team_id), expected.get(team_id)):
+                problems.append(f"teamstats team_id={team_id} stored={stored.get(team_id)} expected={expected.get(team_id)}")
+        stored = {row[0]: tuple(row[1:]) for row in connection.execute(text("SELECT region_id, hero_count, training_count FROM regionstats"))}
+        expected = {row[0]: tuple(row[1:]) for row in connection.execute(text(REGION_STATS_SELECT))}
+        for region_id in stored.keys() | expected.keys():
+            if stored.get(region_id) != expected.get(region_id):
+                problems.append(f"regionstats region_id={region_id} stored={stored.get(region_id)} expected={expected.get(region_id)}")
+    return problems
@@ -2,7 +2,8 @@ import os
 from dotenv import load_dotenv
 from sqlmodel import Session, select
 from sqlmodel import SQLModel, Field, Relationship, col, or_
-from .db import engine, create_db_and_tables
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from .db import engine, create_db_and_tables, has_unique_name_index, rebuild_rollups, check_rollups
 
 # from .models.team_model import Team
 # from .models.hero_model import Hero
@@ -36,6 +37,19 @@ class Hero(SQLModel, table=True):
     team: Team | None = Relationship(back_populates="heroes")
     regions: list[Region] = Relationship(back_populates="heroes", link_model=HeroRegionLink)
 
+# rollups maintained by the triggers in db.py, don't write to these directly
+class TeamStats(SQLModel, table=True):
+    team_id: int = Field(foreign_key="team.id", primary_key=True)
+    hero_count: int = 0
+    age_sum: int = 0
+    aged_count: int = 0
+    avg_age: float | None = None
+
+class RegionStats(SQLModel, table=True):
+    region_id: int = Field(foreign_key="region.id", primary_key=True)
+    hero_count: int = 0
+    training_count: int = 0
+
 # HERO CREATE
 def create_hero(hero: Hero) -> Hero:
     try:
@@ -74,6 +88,61 @@ def add_hero_to_team(hero: Hero, team: Team) -> Hero:
         except Exception as e:
             raise e
 
+# UPSERTS
+# these need the unique name indexes from create_db_and_tables(unique_names=True)
+# rows are matched on name, so running the same batch twice doesn't make duplicates
+UPSERT_BATCH_SIZE = 500
+
+# returns (inserted, updated), rows left alone by an empty update_columns aren't counted as updated
+def upsert_by_name(model: type[SQLModel], rows: list[dict], update_columns: list[str], batch_size: int = UPSERT_BATCH_SIZE) -> tuple[int, int]:
+    if batch_size < 1:
+        raise ValueError(f"batch_size must be at least 1, got {batch_size}")
+    table = model.__tablename__
+    if not has_unique_name_index(table):
+        raise RuntimeError(f"Upserting {table} needs a unique index on name, call create_unique_name_indexes() first")
+    inserted = 0
+    updated = 0
+    with Session(engine) as session:
+        try:
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                names = {row["name"] for row in batch}
+                # one lookup per batch so we can tell inserts from updates
+                statement = select(model.name).where(col(model.name).in_(names))
+                existing = set(session.exec(statement).all())
+                statement = sqlite_insert(model).values(batch)
+                if update_columns:
+                    statement = statement.on_conflict_do_update(
+                        index_elements=["name"],
+                        set_={column: statement.excluded[column] for column in update_columns},
+                    )
+                else:
+                    statement = statement.on_conflict_do_nothing(index_elements=["name"])
+                session.exec(statement)
+                # a name repeated inside a batch is inserted once and then updated
+                inserted += len(names - existing)
+                if update_columns:
+                    updated += len(batch) - len(names - existing)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            raise e
+    return (inserted, updated)
+
+# only columns are written, relationships aren't followed, so set team_id rather than team
+def upsert_heroes(heroes: list[Hero], batch_size: int = UPSERT_BATCH_SIZE) -> tuple[int, int]:
+    rows = [hero.model_dump(exclude={"id"}) for hero in heroes]
+    return upsert_by_name(Hero, rows, ["secret_name", "age", "team_id"], batch_size)
+
+def upsert_teams(teams: list[Team], batch_size: int = UPSERT_BATCH_SIZE) -> tuple[int, int]:
+    rows = [team.model_dump(exclude={"id"}) for team in teams]
+    return upsert_by_name(Team, rows, ["headquarters"], batch_size)
+
+# regions only have a name so an existing region is left alone
+def upsert_regions(regions: list[Region], batch_size: int = UPSERT_BATCH_SIZE) -> tuple[int, int]:
+    rows = [region.model_dump(exclude={"id"}) for region in regions]
+    return upsert_by_name(Region, rows, [], batch_size)
+
 # HERO RETRIEVE 
 def select_hero_by_name(name: str) -> Hero:
     with Session(engine) as session:
@@ -234,6 +303,10 @@ def select_heroes_by_team(team: Team) -> list[Hero]:
     except Exception as e:
         raise e
 
+def select_team_stats(team: Team) -> TeamStats:
+    with Session(engine) as session:
+        return session.get(TeamStats, team.id)
+
 # REGION RETRIVE 
 def select_region_by_name(region_name: str) -> Region:
     with Session(engine) as session:
@@ -254,6 +327,10 @@ def select_heroes_in_region(region: Region) -> list[Hero]:
         else:
             return []
 
+def select_region_stats(region: Region) -> RegionStats:
+    with Session(engine) as session:
+        return session.get(RegionStats, region.id)
+
 # REGION UPDATE
 # Would probably make this a hero update since it returns hero
 # could rewrite it to manipulate and return a region...
@@ -312,7 +389,7 @@ def main():
     except:
         print("No database.db to delete")
 
-    create_db_and_tables()
+    create_db_and_tables(unique_names=True)
 
     team_preventers = Team(name="Preventers", headquarters="Sharp Tower")
     
@@ -505,5 +582,35 @@ def main():
     print("HRL: " + str(spidey_hrl))
     print(str(select_hero_region_link_by_hrl(spidey_hrl)))
 
+    print()
+    print("Upsert heroes. Rusty-Man gets older, Ms. Marvelous is new")
+    inserted, updated = upsert_heroes([
+        Hero(name="Rusty-Man", secret_name="Tommy Sharp", age=49, team_id=team_preventers.id),
+        Hero(name="Ms. Marvelous", secret_name="Kamala Kahn", age=17),
+    ])
+    print(f"Inserted: {inserted} Updated: {updated}")
+    print(select_hero_by_name("Rusty-Man"))
+
+    print()
+    print("Upsert the same teams and regions again")
+    inserted, updated = upsert_teams([
+        Team(name="Preventers", headquarters="Sharp Tower"),
+        Team(name="Z-Force", headquarters="Sister Margaret's Bar"),
+    ])
+    print(f"Teams Inserted: {inserted} Updated: {updated}")
+    inserted, updated = upsert_regions([Region(name="Earth"), Region(name="Asgard")])
+    print(f"Regions Inserted: {inserted} Updated: {updated}")
+
+    print()
+    print("Preventers and Multiverse stats without loading heroes")
+    print(select_team_stats(team_preventers))
+    print(select_region_stats(region_multiverse))
+
+    print()
+    print("Rollup problems before and after a rebuild")
+    print(check_rollups())
+    rebuild_rollups()
+    print(check_rollups())
+
 if __name__ == "__main__":
     main()
\ No newline at end of file